@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks of the signing hot paths.
+
+    Run with ``make bench``, or directly::
+
+        $ python benchmarks/bench_signing.py --output before.json
+        $ python benchmarks/bench_signing.py --compare before.json
+
+    Each benchmark is repeated and the best run is kept. Results are
+    written as JSON so that two runs (e.g. two commits) can be compared.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from s3signedauth import s3signedauth, sigv4, verifier, metrics  # noqa
+
+TIMESTAMP = datetime(2014, 10, 1, 0, 42)
+ASCII_KEY = '/vacation 2006/Paris/0001.png'
+UNICODE_KEY = '/photo✔ 汉字😓/空格后表情：😍. p n g'
+DEFAULT_SIZES = (1000, 100000)
+
+
+def _signer(**kwargs):
+    return s3signedauth.S3SignedURL(AWS_KEY='ok', AWS_SECRET_KEY='pouet',
+                                    BUCKET_NAME='panier', **kwargs)
+
+
+def _keys(count, template='/photos/%08d.png'):
+    return [template % i for i in range(count)]
+
+
+def _best(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def single_call(output, key, calls=20000, **signer_options):
+    signer = _signer(**signer_options)
+
+    def run():
+        sign = signer.sign_get_file
+        for _ in range(calls):
+            sign(key, output=output, timestamp=TIMESTAMP)
+    return run, calls
+
+
+def single_call_unique(calls=20000, **signer_options):
+    signer = _signer(**signer_options)
+    keys = _keys(calls)
+
+    def run():
+        sign = signer.sign_get_file
+        for key in keys:
+            sign(key, timestamp=TIMESTAMP)
+    return run, calls
+
+
+def single_headers(calls=20000):
+    signer = _signer()
+    headers = {'x-amz-acl': 'public-read', 'x-amz-meta-owner': 'paulo'}
+
+    def run():
+        sign = signer.sign_put_file
+        for _ in range(calls):
+            sign(ASCII_KEY, headers=headers, timestamp=TIMESTAMP)
+    return run, calls
+
+
+def batch(count, template='/photos/%08d.png'):
+    signer = _signer()
+    keys = _keys(count, template)
+
+    def run():
+        signer.sign_many('GET', keys, timestamp=TIMESTAMP)
+    return run, count
+
+
+def batch_headers(count):
+    signer = _signer()
+    keys = _keys(count)
+    headers = {'Content-MD5': '4gJE4saaMU4BqNR0kLY+lw==',
+               'x-amz-acl': 'public-read', 'x-amz-meta-owner': 'paulo'}
+
+    def run():
+        signer.sign_many('PUT', keys, headers=headers, timestamp=TIMESTAMP)
+    return run, count
+
+
+def presigned_urls(count):
+    signer = _signer()
+    keys = _keys(count)
+
+    def run():
+        for _ in signer.iter_presigned_urls(keys, timestamp=TIMESTAMP):
+            pass
+    return run, count
+
+
+def presigned_urls_window(count):
+    # Repeated requests for the same files within a window, served from
+    # the cache.
+    signer = _signer(CACHE_SIZE=count)
+    keys = _keys(count)
+
+    def run():
+        for _ in signer.iter_presigned_urls(keys, timestamp=TIMESTAMP,
+                                            window=300):
+            pass
+    return run, count
+
+
+def post_policy(calls=20000):
+    signer = _signer()
+    conditions = [{'acl': 'public-read'},
+                  ['content-length-range', 0, 10485760]]
+
+    def run():
+        sign = signer.sign_post_policy
+        for i in range(calls):
+            sign('uploads/%d/' % i, conditions, timestamp=TIMESTAMP)
+    return run, calls
+
+
+def registry_sign(calls=20000):
+    registry = s3signedauth.SignerRegistry()
+    for i in range(1000):
+        registry.add('key%d' % i, 'secret%d' % i, BUCKET_NAME='panier')
+
+    def run():
+        sign = registry.sign
+        for i in range(calls):
+            sign('key%d' % (i % 1000), 'GET', ASCII_KEY, timestamp=TIMESTAMP)
+    return run, calls
+
+
+def verify(calls=20000):
+    signer = _signer()
+    checker = verifier.RequestVerifier(signer, REJECT_REPLAYS=False)
+    headers = {'Authorization': signer.sign_get_file(
+        ASCII_KEY, output='http_header', timestamp=TIMESTAMP),
+        'x-amz-date': 'Wed, 01 Oct 2014 00:42:00 GMT'}
+    now = 1412124120
+    path = '/panier' + ASCII_KEY
+
+    def run():
+        check = checker.verify
+        for _ in range(calls):
+            check('GET', path, headers, now=now)
+    return run, calls
+
+
+def sigv4_call(calls=10000):
+    signer = sigv4.S3SignedURLV4(AWS_KEY='ok', AWS_SECRET_KEY='pouet',
+                                 BUCKET_NAME='panier')
+
+    def run():
+        sign = signer.sign_get_file
+        for _ in range(calls):
+            sign(ASCII_KEY, timestamp=TIMESTAMP)
+    return run, calls
+
+
+def benchmarks(sizes):
+    # Yields (name, factory) pairs, factories build the fixtures of the
+    # benchmarks, so that skipped ones never allocate their keys.
+    partial = functools.partial
+    yield 'single.raw', partial(single_call, None, ASCII_KEY)
+    yield 'single.http_header', partial(single_call, 'http_header',
+                                        ASCII_KEY)
+    yield 'single.query_string', partial(single_call, 'query_string',
+                                         ASCII_KEY)
+    yield 'single.unicode', partial(single_call, None, UNICODE_KEY)
+    yield 'single.headers', single_headers
+    yield 'single.metrics', partial(single_call, None, ASCII_KEY,
+                                    METRICS=metrics.SigningMetrics())
+    yield 'cache.hit', partial(single_call, None, ASCII_KEY,
+                               CACHE_SIZE=1000)
+    yield 'cache.miss', partial(single_call_unique, CACHE_SIZE=1000)
+    for size in sizes:
+        yield 'batch.%d' % size, partial(batch, size)
+        yield 'batch.unicode.%d' % size, partial(batch, size,
+                                                 UNICODE_KEY + '%08d')
+        yield 'batch.headers.%d' % size, partial(batch_headers, size)
+        yield 'presign.%d' % size, partial(presigned_urls, size)
+        yield 'presign.window.%d' % size, partial(presigned_urls_window,
+                                                  size)
+    yield 'post_policy', post_policy
+    yield 'registry.sign', registry_sign
+    yield 'verify.header', verify
+    yield 'sigv4.single', sigv4_call
+
+
+def run(sizes, repeat, only=None, stream=sys.stdout):
+    results = {}
+    for name, factory in benchmarks(sizes):
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        func, ops = factory()
+        elapsed = _best(func, repeat)
+        results[name] = {'ops': ops,
+                         'seconds': elapsed,
+                         'ops_per_sec': ops / elapsed,
+                         'usec_per_op': elapsed * 1e6 / ops}
+        stream.write('%-24s %12.0f ops/s %10.2f usec/op\n' % (
+            name, results[name]['ops_per_sec'],
+            results[name]['usec_per_op']))
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, stream=sys.stdout):
+    stream.write('\n%-24s %12s %12s %8s\n' % ('benchmark', 'baseline',
+                                              'current', 'speedup'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['ops_per_sec']
+        after = results[name]['ops_per_sec']
+        stream.write('%-24s %12.0f %12.0f %7.2fx\n' % (name, before, after,
+                                                       after / before))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='Comma separated batch sizes (default: '
+                             '1000,100000, add 1000000 for the full run).')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', action='append',
+                        help='Only run benchmarks starting with this prefix.')
+    parser.add_argument('--output', help='Write the results to this file.')
+    parser.add_argument('--compare', help='Results file to compare to.')
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    results = run(sizes, args.repeat, args.only)
+    report = {'commit': _commit(),
+              'date': datetime.now(timezone.utc).isoformat(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline)['results'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import time
+import heapq
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, max_size, ttl=None, clock=time.time):
+        if not max_size or max_size < 1:
+            raise Exception('max_size must be a positive integer.')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > self.clock():
+                    # Re-inserting moves the key to the most recently
+                    # used end.
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires_at = None if ttl is None else self.clock() + ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        # Stores the value only if the key is missing or expired, and
+        # tells whether it did, as a single atomic operation.
+        if ttl is None:
+            ttl = self.ttl
+        now = self.clock()
+        expires_at = None if ttl is None else now + ttl
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                return False
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and (entry[1] is None or
+                                      entry[1] > self.clock())
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ExpiringSet(object):
+    # Keys remembered until they expire, e.g. accepted signatures. Unlike
+    # LRUCache, a key is never forgotten before it expires: once full of
+    # unexpired keys, new ones are refused.
+
+    def __init__(self, max_size):
+        if not max_size or max_size < 1:
+            raise Exception('max_size must be a positive integer.')
+        self.max_size = max_size
+        # Keys refused because the set was full.
+        self.overflows = 0
+        self._expiries = {}
+        # (expires_at, key) of the keys, soonest to expire first.
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def add(self, key, expires_at, now):
+        # Stores the key if it is missing or expired and there is room for
+        # it, and tells whether it did, as a single atomic operation.
+        with self._lock:
+            expiries = self._expiries
+            known = expiries.get(key)
+            if known is not None and known > now:
+                return False
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                expired_at, expired = heapq.heappop(heap)
+                # Stale when the key was added again since.
+                if expiries.get(expired) == expired_at:
+                    del expiries[expired]
+            if len(expiries) >= self.max_size:
+                self.overflows += 1
+                return False
+            expiries[key] = expires_at
+            heapq.heappush(heap, (expires_at, key))
+            return True
+
+    def __len__(self):
+        return len(self._expiries)
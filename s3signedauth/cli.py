@@ -0,0 +1,370 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+from collections import deque
+from io import StringIO
+from datetime import datetime, timezone
+
+from .s3signedauth import S3SignedURL, DEFAULT_EXPIRES_IN, _format_date
+
+DEFAULT_CHUNK_SIZE = 10000
+MODES = ('signature', 'http_header', 'query_string', 'url')
+
+# Signer of the worker processes, built once by _init_worker.
+_worker = None
+
+
+def _init_worker(options):
+    global _worker
+    signer = S3SignedURL(AWS_KEY=options['aws_key'],
+                         AWS_SECRET_KEY=options['aws_secret_key'],
+                         BUCKET_NAME=options['bucket'])
+    _worker = (signer, options)
+
+
+def _sign_chunk(chunk):
+    # Workers also format their results, the parent process only has to
+    # read keys and write the returned text out.
+    signer, options = _worker
+    keys = [key for _, key in chunk]
+    if options['mode'] == 'url':
+        values = signer.iter_presigned_urls(keys, method=options['method'],
+                                            expires_in=options['expires_in'],
+                                            host_style=options['host_style'],
+                                            mime_type=options['mime_type'],
+                                            timestamp=options['timestamp'])
+    else:
+        output = options['mode'] if options['mode'] != 'signature' else None
+        values = signer.iter_sign(options['method'], keys, output=output,
+                                  mime_type=options['mime_type'],
+                                  timestamp=options['timestamp'])
+    field, date = options['field'], options['date']
+    if options['output_format'] == 'csv':
+        buf = StringIO()
+        extra = [date] if date else []
+        csv.writer(buf).writerows([key, value] + extra
+                                  for (key, _), value in zip(chunk, values))
+        return buf.getvalue()
+    lines = []
+    for (key, _), value in zip(chunk, values):
+        record = {'key': key, field: value}
+        if date:
+            record['x-amz-date'] = date
+        lines.append(json.dumps(record) + '\n')
+    return ''.join(lines)
+
+
+def _iter_signed_chunks(chunks, options, workers):
+    if workers == 1:
+        _init_worker(options)
+        for chunk in chunks:
+            yield _sign_chunk(chunk)
+        return
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(options,))
+    try:
+        # Only a couple of chunks per worker are in flight at any time, so
+        # memory stays bounded whatever the size of the input, and results
+        # are collected in submission order.
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_sign_chunk, (chunk,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def _read_keys(stream, input_format, key_field):
+    if input_format == 'lines':
+        keys = (line.rstrip('\r\n') for line in stream)
+    elif input_format == 'jsonl':
+        keys = (json.loads(line)[key_field] for line in stream
+                if line.strip())
+    else:
+        keys = (row[key_field] for row in csv.DictReader(stream))
+    for key in keys:
+        if not key:
+            continue
+        # S3 object keys are relative to the bucket, the signer expects
+        # them to start with a "/".
+        yield key, key if key.startswith('/') else '/' + key
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _counted(chunks, counter):
+    for chunk in chunks:
+        counter[0] += len(chunk)
+        yield chunk
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(
+        prog='s3-signed-auth',
+        description='Sign and authenticate AWS S3 HTTP requests.')
+    commands = parser.add_subparsers(dest='command')
+    # Sub-commands are optional by default on Python 3.
+    commands.required = True
+    sign = commands.add_parser(
+        'sign', help='Sign the object keys of a manifest.')
+    sign.add_argument('input', nargs='?', default='-',
+                      help='Manifest of object keys, "-" for stdin '
+                           '(default).')
+    sign.add_argument('-o', '--output', default='-',
+                      help='Where to write the results, "-" for stdout '
+                           '(default).')
+    sign.add_argument('--input-format', choices=('lines', 'csv', 'jsonl'),
+                      default='lines',
+                      help='One key per line, a CSV file with a header row '
+                           'or JSON objects, one per line.')
+    sign.add_argument('--output-format', choices=('csv', 'jsonl'),
+                      default='jsonl')
+    sign.add_argument('--key-field', default='key',
+                      help='CSV column or JSON field holding the object key '
+                           '(default: key).')
+    sign.add_argument('--bucket', required=True)
+    sign.add_argument('--method', default='GET')
+    sign.add_argument('--mode', choices=MODES, default='url',
+                      help='What to output for each key (default: url).')
+    sign.add_argument('--mime-type')
+    sign.add_argument('--expires-in', type=int, default=DEFAULT_EXPIRES_IN,
+                      help='Validity of the URLs in seconds (default: 900).')
+    sign.add_argument('--host-style', choices=('virtual', 'path'),
+                      default='virtual')
+    sign.add_argument('--aws-key',
+                      default=os.environ.get('AWS_ACCESS_KEY_ID'),
+                      help='Default: $AWS_ACCESS_KEY_ID.')
+    sign.add_argument('--aws-secret-key',
+                      default=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                      help='Default: $AWS_SECRET_ACCESS_KEY.')
+    sign.add_argument('-j', '--workers', type=int,
+                      default=multiprocessing.cpu_count(),
+                      help='Number of worker processes (default: number of '
+                           'CPUs).')
+    sign.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                      help='Number of keys sent to a worker at once.')
+    serve = commands.add_parser(
+        'serve', help='Run a signing server.')
+    serve.add_argument('--host', default='127.0.0.1',
+                       help='Address to listen on (default: 127.0.0.1).')
+    serve.add_argument('--port', type=int, default=8080)
+    serve.add_argument('--bucket', help='Default bucket name.')
+    serve.add_argument('--aws-key',
+                       default=os.environ.get('AWS_ACCESS_KEY_ID'),
+                       help='Default: $AWS_ACCESS_KEY_ID.')
+    serve.add_argument('--aws-secret-key',
+                       default=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                       help='Default: $AWS_SECRET_ACCESS_KEY.')
+    serve.add_argument('-j', '--workers', type=int,
+                       default=multiprocessing.cpu_count(),
+                       help='Number of worker processes for large batches, '
+                            '0 to sign everything on the event loop '
+                            '(default: number of CPUs).')
+    serve.add_argument('--time-bucket', type=int, default=1,
+                       help='Requests received within the same number of '
+                            'seconds share their timestamp (default: 1).')
+    serve.add_argument('--offload-threshold', type=int, default=1000,
+                       help='Size from which batches are signed by the '
+                            'workers (default: 1000).')
+    fake_s3 = commands.add_parser(
+        'fake-s3', help='Run a local S3 stand-in which only checks '
+                        'signatures.')
+    fake_s3.add_argument('--host', default='127.0.0.1',
+                         help='Address to listen on (default: 127.0.0.1).')
+    fake_s3.add_argument('--port', type=int, default=9000)
+    loadtest = commands.add_parser(
+        'loadtest', help='Sign and send requests concurrently to a local '
+                         'S3 stand-in.')
+    loadtest.add_argument('--endpoint',
+                          help='host:port of a running "fake-s3" server, '
+                               'one is started in process by default.')
+    loadtest.add_argument('--bucket', default='loadtest')
+    loadtest.add_argument('--method', default='GET')
+    loadtest.add_argument('--mode', choices=('http_header', 'url'),
+                          default='http_header',
+                          help='Header or query string signatures '
+                               '(default: http_header).')
+    loadtest.add_argument('-n', '--requests', type=int, default=10000)
+    loadtest.add_argument('-c', '--concurrency', type=int, default=8)
+    for command in (fake_s3, loadtest):
+        command.add_argument('--aws-key',
+                             default=os.environ.get('AWS_ACCESS_KEY_ID'),
+                             help='Default: $AWS_ACCESS_KEY_ID.')
+        command.add_argument('--aws-secret-key',
+                             default=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                             help='Default: $AWS_SECRET_ACCESS_KEY.')
+    return parser
+
+
+def _sign(args, stdin, stdout, stderr):
+    if not args.aws_key or not args.aws_secret_key:
+        stderr.write('s3-signed-auth: AWS key and secret key required.\n')
+        return 2
+    # The whole run shares one timestamp so that every signature of a
+    # manifest is made for the same date or expiry.
+    timestamp = datetime.now(timezone.utc).replace(tzinfo=None,
+                                                   microsecond=0)
+    field = 'url' if args.mode == 'url' else 'signature'
+    options = {'aws_key': args.aws_key,
+               'aws_secret_key': args.aws_secret_key,
+               'bucket': args.bucket,
+               'method': args.method.upper(),
+               'mode': args.mode,
+               'mime_type': args.mime_type,
+               'expires_in': args.expires_in,
+               'host_style': args.host_style,
+               'timestamp': timestamp,
+               'output_format': args.output_format,
+               'field': field,
+               # Header signatures are only valid along with their date.
+               'date': _format_date(timestamp)[0] if field != 'url' else None}
+    # Check the credentials and bucket once, before starting the workers.
+    _init_worker(options)
+    # The csv module does its own newline handling.
+    source = stdin if args.input == '-' else open(args.input, newline='',
+                                                  encoding='utf-8')
+    target = stdout if args.output == '-' else open(args.output, 'w',
+                                                    newline='',
+                                                    encoding='utf-8')
+    started = time.time()
+    counter = [0]
+    try:
+        if args.output_format == 'csv':
+            header = ['key', field] + (['x-amz-date'] if options['date']
+                                       else [])
+            csv.writer(target).writerow(header)
+        keys = _read_keys(source, args.input_format, args.key_field)
+        chunks = _chunked(keys, max(args.chunk_size, 1))
+        for text in _iter_signed_chunks(_counted(chunks, counter), options,
+                                        max(args.workers, 1)):
+            target.write(text)
+    finally:
+        if source is not stdin:
+            source.close()
+        if target is not stdout:
+            target.close()
+    elapsed = time.time() - started
+    count = counter[0]
+    stderr.write('Signed %d keys in %.2fs (%d keys/s).\n' % (
+        count, elapsed, count / elapsed if elapsed else 0))
+    return 0
+
+
+def _serve(args, stderr):
+    if not args.aws_key or not args.aws_secret_key:
+        stderr.write('s3-signed-auth: AWS key and secret key required.\n')
+        return 2
+    from .server import SigningServer
+    server = SigningServer(AWS_KEY=args.aws_key,
+                           AWS_SECRET_KEY=args.aws_secret_key,
+                           BUCKET_NAME=args.bucket, HOST=args.host,
+                           PORT=args.port, WORKERS=max(args.workers, 0),
+                           TIME_BUCKET=args.time_bucket,
+                           OFFLOAD_THRESHOLD=args.offload_threshold)
+    stderr.write('Listening on http://%s:%d/sign\n' % server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def _fake_s3(args, stderr):
+    if not args.aws_key or not args.aws_secret_key:
+        stderr.write('s3-signed-auth: AWS key and secret key required.\n')
+        return 2
+    from .loadtest import FakeS3Server
+    signer = S3SignedURL(AWS_KEY=args.aws_key,
+                         AWS_SECRET_KEY=args.aws_secret_key)
+    server = FakeS3Server(signer, HOST=args.host, PORT=args.port)
+    stderr.write('Listening on http://%s:%d/\n' % server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def _loadtest(args, stdout, stderr):
+    import threading
+    from .loadtest import FakeS3Server, LoadGenerator
+    server = None
+    aws_key, aws_secret_key = args.aws_key, args.aws_secret_key
+    if args.endpoint:
+        if not aws_key or not aws_secret_key:
+            stderr.write('s3-signed-auth: AWS key and secret key '
+                         'required.\n')
+            return 2
+        host, _, port = args.endpoint.rpartition(':')
+        port = int(port)
+    elif not aws_key or not aws_secret_key:
+        # Any credentials will do for a stand-in started here.
+        aws_key, aws_secret_key = 'loadtest', 'loadtest'
+    signer = S3SignedURL(AWS_KEY=aws_key, AWS_SECRET_KEY=aws_secret_key,
+                         BUCKET_NAME=args.bucket)
+    if not args.endpoint:
+        server = FakeS3Server(signer, PORT=0)
+        host, port = server.address
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    try:
+        generator = LoadGenerator(signer, HOST=host, PORT=port,
+                                  CONCURRENCY=args.concurrency,
+                                  MODE=args.mode, METHOD=args.method)
+        report = generator.run(args.requests)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    stdout.write('%d requests in %.2fs (%d requests/s)\n'
+                 'p50: %.2fms p99: %.2fms\n'
+                 'ok: %d verification failures: %d errors: %d\n' % (
+                     report['requests'], report['seconds'],
+                     report['requests_per_sec'],
+                     (report['p50'] or 0) * 1000,
+                     (report['p99'] or 0) * 1000, report['ok'],
+                     report['failures'], report['errors']))
+    return 1 if report['failures'] or report['errors'] else 0
+
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    args = _build_parser().parse_args(argv)
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    try:
+        if args.command == 'serve':
+            return _serve(args, stderr)
+        if args.command == 'fake-s3':
+            return _fake_s3(args, stderr)
+        if args.command == 'loadtest':
+            return _loadtest(args, stdout, stderr)
+        return _sign(args, stdin, stdout, stderr)
+    except Exception as ex:
+        stderr.write('s3-signed-auth: %s\n' % ex)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+import time
+import calendar
+import threading
+from datetime import datetime
+
+# Credentials are renewed 5 minutes before they expire, and the provider
+# called again every 30 seconds when it fails.
+DEFAULT_REFRESH_BEFORE = 300
+DEFAULT_RETRY_INTERVAL = 30
+# Renewal interval of credentials the provider gives no expiry for.
+DEFAULT_REFRESH_INTERVAL = 3600
+
+
+def _epoch(expires_at):
+    if isinstance(expires_at, datetime):
+        # Naive datetimes are taken as UTC, as given by STS.
+        return calendar.timegm(expires_at.utctimetuple())
+    return expires_at
+
+
+class CredentialRefresher(threading.Thread):
+
+    def __init__(self, signer, provider,
+                 REFRESH_BEFORE=DEFAULT_REFRESH_BEFORE,
+                 RETRY_INTERVAL=DEFAULT_RETRY_INTERVAL,
+                 REFRESH_INTERVAL=DEFAULT_REFRESH_INTERVAL):
+        super(CredentialRefresher, self).__init__(
+            name='CredentialRefresher')
+        # Never keeps the process alive
+        self.daemon = True
+        self.signer = signer
+        # Returns an (AWS_KEY, AWS_SECRET_KEY, expires_at) tuple, expires_at
+        # being a UTC datetime, a UNIX timestamp or None, optionally followed
+        # by the session token of temporary credentials.
+        self.provider = provider
+        self.REFRESH_BEFORE = REFRESH_BEFORE
+        self.RETRY_INTERVAL = RETRY_INTERVAL
+        self.REFRESH_INTERVAL = REFRESH_INTERVAL
+        self.expires_at = None
+        self.last_error = None
+        self.clock = time.time
+        self._stopped = threading.Event()
+
+    def refresh(self):
+        # Returns the number of seconds until the next refresh.
+        credentials = self.provider()
+        aws_key, aws_secret_key, expires_at = credentials[:3]
+        session_token = credentials[3] if len(credentials) > 3 else None
+        # The token is swapped along with the keys it was issued for.
+        self.signer.rotate_credentials(aws_key, aws_secret_key,
+                                       SESSION_TOKEN=session_token)
+        self.expires_at = _epoch(expires_at)
+        self.last_error = None
+        if self.expires_at is None:
+            return self.REFRESH_INTERVAL
+        # At least a second apart, whatever the provider returns.
+        return max(self.expires_at - self.REFRESH_BEFORE - self.clock(), 1)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                delay = self.refresh()
+            except Exception as ex:
+                # The current credentials are kept until the provider
+                # recovers.
+                self.last_error = ex
+                delay = self.RETRY_INTERVAL
+            self._stopped.wait(delay)
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,209 @@
+import math
+import time
+import hashlib
+import threading
+import itertools
+import http.client
+import http.server
+import socketserver
+from urllib.parse import parse_qsl, quote, unquote
+
+from .s3signedauth import (DEFAULT_EXPIRES_IN, _filepath, _format_date,
+                           _utcnow)
+from .verifier import RequestVerifier
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 9000
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REQUESTS = 10000
+MODES = ('http_header', 'url')
+
+_ERROR_BODY = ('<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{0}'
+               '</Code><Message>{1}</Message></Error>')
+
+
+def _percentile(latencies, percent):
+    # Nearest-rank percentile of sorted latencies.
+    if not latencies:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(latencies)))
+    return latencies[max(rank, 1) - 1]
+
+
+class _FakeS3Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle's algorithm would
+    # delay each keep-alive response until the client acknowledges the
+    # headers.
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        path, _, query = self.path.partition('?')
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if query:
+            headers_or_query = dict(parse_qsl(query, keep_blank_values=True))
+        else:
+            headers_or_query = dict(self.headers.items())
+        accepted = self.server.verifier.verify(self.command, unquote(path),
+                                               headers_or_query)
+        self.server.count(accepted)
+        if not accepted:
+            return self._respond(403, _ERROR_BODY.format(
+                'SignatureDoesNotMatch', 'The request signature we '
+                'calculated does not match the signature you provided.'))
+        if self.command == 'PUT':
+            return self._respond(200, '', [
+                ('ETag', '"%s"' % hashlib.md5(body).hexdigest())])
+        if self.command == 'DELETE':
+            return self._respond(204, '')
+        self._respond(200, '')
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = _handle
+
+    def _respond(self, status, body, headers=()):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if body:
+            self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeS3Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+    # Load generators open many connections at once.
+    request_queue_size = 128
+
+    def __init__(self, signers, HOST=DEFAULT_HOST, PORT=DEFAULT_PORT,
+                 REJECT_REPLAYS=False):
+        # Load tests sign the same requests many times within a second,
+        # replays are only rejected when asked to.
+        self.verifier = RequestVerifier(signers,
+                                        REJECT_REPLAYS=REJECT_REPLAYS)
+        self.accepted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        http.server.HTTPServer.__init__(self, (HOST, PORT), _FakeS3Handler)
+        self.address = self.socket.getsockname()
+
+    def count(self, accepted):
+        with self._lock:
+            if accepted:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+
+
+class LoadGenerator(object):
+
+    def __init__(self, signer, HOST=DEFAULT_HOST, PORT=DEFAULT_PORT,
+                 CONCURRENCY=DEFAULT_CONCURRENCY, MODE='http_header',
+                 METHOD='GET', BUCKET_NAME=None):
+        if MODE not in MODES:
+            raise Exception('MODE must be either "http_header" or "url".')
+        if CONCURRENCY < 1:
+            raise Exception('CONCURRENCY must be at least 1.')
+        self.signer = signer
+        self.HOST = HOST
+        self.PORT = PORT
+        self.CONCURRENCY = CONCURRENCY
+        self.MODE = MODE
+        self.METHOD = METHOD.upper()
+        self.BUCKET_NAME = BUCKET_NAME or signer.BUCKET_NAME
+        if not self.BUCKET_NAME:
+            raise Exception('No bucket name provided')
+        # The signer refuses a bucket name when it already has one.
+        self._options = {}
+        if not signer.has_bucket_name:
+            self._options['bucket_name'] = self.BUCKET_NAME
+
+    def _request(self, filename):
+        # Returns the (path, headers) of a signed request.
+        timestamp = _utcnow()
+        if self.MODE == 'url':
+            url = self.signer.presign_url(
+                self.METHOD, filename, expires_in=DEFAULT_EXPIRES_IN,
+                host_style='path', timestamp=timestamp,
+                endpoint='%s:%d' % (self.HOST, self.PORT), scheme='http',
+                **self._options)
+            return url[url.index('/', len('http://')):], {}
+        options = dict(self._options, timestamp=timestamp,
+                       output='http_header')
+        authorization = self.signer._sign_operation(self.METHOD, filename,
+                                                    options)
+        return (quote(_filepath(self.BUCKET_NAME, filename)),
+                {'Authorization': authorization,
+                 'x-amz-date': _format_date(timestamp)[0]})
+
+    def _worker(self, filenames, latencies, counts):
+        connection = http.client.HTTPConnection(self.HOST, self.PORT)
+        timer = time.perf_counter
+        try:
+            for filename in filenames:
+                started = timer()
+                try:
+                    path, headers = self._request(filename)
+                except Exception:
+                    # e.g. an invalid filename, counted as an error
+                    path = None
+                status = None
+                try:
+                    if path is not None:
+                        connection.request(self.METHOD, path, b'', headers)
+                        response = connection.getresponse()
+                        response.read()
+                        status = response.status
+                except (http.client.HTTPException, OSError):
+                    # Also covers socket errors, the next request reconnects.
+                    connection.close()
+                latencies.append(timer() - started)
+                if status is not None and status < 300:
+                    counts[0] += 1
+                elif status == 403:
+                    counts[1] += 1
+                else:
+                    counts[2] += 1
+        finally:
+            connection.close()
+
+    def run(self, requests=DEFAULT_REQUESTS, filenames=None):
+        # Sends the given number of requests, cycling over filenames, and
+        # returns the report of the run.
+        if filenames is None:
+            filenames = ('/loadtest/%08d' % i for i in itertools.count())
+        filenames = list(itertools.islice(itertools.cycle(filenames),
+                                          requests))
+        results = [([], [0, 0, 0]) for _ in range(self.CONCURRENCY)]
+        threads = [threading.Thread(
+            target=self._worker,
+            args=(filenames[i::self.CONCURRENCY],) + results[i])
+            for i in range(self.CONCURRENCY)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        latencies = sorted(itertools.chain.from_iterable(
+            latencies for latencies, _ in results))
+        ok, failures, errors = [sum(counts[i] for _, counts in results)
+                                for i in range(3)]
+        return {'requests': len(latencies),
+                'ok': ok,
+                'failures': failures,
+                'errors': errors,
+                'seconds': elapsed,
+                'requests_per_sec': len(latencies) / elapsed if elapsed
+                else 0,
+                'p50': _percentile(latencies, 50),
+                'p99': _percentile(latencies, 99)}
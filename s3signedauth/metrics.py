@@ -0,0 +1,75 @@
+import bisect
+import threading
+from timeit import default_timer
+
+# Upper bounds, in seconds, of the latency histogram buckets. The last
+# bucket counts everything slower than 10ms.
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, float('inf'))
+
+
+class _Stats(object):
+
+    __slots__ = ('count', 'errors', 'total_time', 'histogram')
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.histogram = [0] * len(buckets)
+
+
+class SigningMetrics(object):
+
+    timer = staticmethod(default_timer)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, callbacks=None):
+        self.buckets = tuple(buckets)
+        self.callbacks = list(callbacks or [])
+        self._stats = {}
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback):
+        # Called with (operation, output, seconds, error) after each
+        # signature.
+        self.callbacks.append(callback)
+
+    def track_cache(self, name, cache):
+        self._caches[name] = cache
+
+    def record(self, operation, output, seconds, error=False):
+        key = (operation, output or 'raw')
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _Stats(self.buckets)
+            if error:
+                stats.errors += 1
+            else:
+                stats.count += 1
+                stats.total_time += seconds
+                stats.histogram[bisect.bisect_left(self.buckets,
+                                                   seconds)] += 1
+        for callback in self.callbacks:
+            callback(operation, output, seconds, error)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def snapshot(self):
+        operations = {}
+        with self._lock:
+            for (operation, output), stats in self._stats.items():
+                operations.setdefault(operation, {})[output] = {
+                    'count': stats.count,
+                    'errors': stats.errors,
+                    'total_time': stats.total_time,
+                    'histogram': list(zip(self.buckets,
+                                          stats.histogram))}
+        caches = {}
+        for name, cache in self._caches.items():
+            caches[name] = {'hits': cache.hits, 'misses': cache.misses,
+                            'size': len(cache)}
+        return {'operations': operations, 'caches': caches}
@@ -1,82 +1,855 @@
-import urllib
-import sha
-import hmac
-import base64
-from datetime import datetime
+import json
+import hashlib
+import binascii
+import calendar
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from urllib.parse import quote
 
+from .cache import LRUCache
 
-class S3SignedURL():
+# Default validity of presigned URLs, matching the 15 minutes window S3
+# allows for signed requests.
+DEFAULT_EXPIRES_IN = 900
+DEFAULT_ENDPOINT = 's3.amazonaws.com'
+# A cached signature must never be served once the 15 minutes window it
+# was made for is over.
+MAX_CACHE_TTL = 900
+# S3 multipart upload limits
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+DEFAULT_POLICY_CACHE_SIZE = 256
+DEFAULT_TEMPLATE_CACHE_SIZE = 256
+# Query string parameters which are part of the resource to sign.
+SUB_RESOURCES = frozenset([
+    'acl', 'cors', 'delete', 'lifecycle', 'location', 'logging',
+    'notification', 'partNumber', 'policy', 'requestPayment',
+    'response-cache-control', 'response-content-disposition',
+    'response-content-encoding', 'response-content-language',
+    'response-content-type', 'response-expires', 'restore', 'tagging',
+    'torrent', 'uploadId', 'uploads', 'versionId', 'versioning', 'versions',
+    'website'])
 
-    def __init__(self, AWS_KEY=None, AWS_SECRET_KEY=None, BUCKET_NAME=None):
+# RFC 1123 names, so that dates do not depend on the current locale.
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug',
+           'Sep', 'Oct', 'Nov', 'Dec')
+# Last formatted second, as a (key, date, x-amz-date header line) tuple.
+# It is replaced as a whole so concurrent readers never see a mixed state.
+_last_date = (None, None, None)
+
+# HMAC (RFC 2104) padding of the key, for SHA1 64 bytes blocks.
+_HMAC_BLOCK_SIZE = 64
+_TRANS_5C = bytes(x ^ 0x5C for x in range(256))
+_TRANS_36 = bytes(x ^ 0x36 for x in range(256))
+
+# Serialized POST policy templates, shared by all the signers as they do not
+# depend on the credentials.
+_policy_templates = LRUCache(DEFAULT_POLICY_CACHE_SIZE)
+# Compiled string to sign templates, per shape of the signed headers (their
+# names) and of the sub-resources (their names and whether they have a
+# value).
+_header_templates = LRUCache(DEFAULT_TEMPLATE_CACHE_SIZE)
+_resource_templates = LRUCache(DEFAULT_TEMPLATE_CACHE_SIZE)
+# String to sign without any header to canonicalize. The arguments of the
+# templates are the method, the mime type, the Date field, the x-amz-date
+# header line, the resource and then the header values.
+_PLAIN_TEMPLATE = '{0}\n\n{1}\n{2}\n{3}{4}'
+
+
+def _format_date(timestamp):
+    global _last_date
+    key = (timestamp.year, timestamp.month, timestamp.day, timestamp.hour,
+           timestamp.minute, timestamp.second)
+    last = _last_date
+    if last[0] == key:
+        return last[1], last[2]
+    timestamp_str = '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        _WEEKDAYS[timestamp.weekday()], key[2], _MONTHS[key[1]], key[0],
+        key[3], key[4], key[5])
+    date_header_value = 'x-amz-date:' + timestamp_str
+    _last_date = (key, timestamp_str, date_header_value)
+    return timestamp_str, date_header_value
+
+
+def _utcnow():
+    # Timestamps are naive datetimes in UTC, datetime.utcnow is deprecated.
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _utcfromtimestamp(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None)
+
+
+def _window_start(timestamp, window):
+    # Snaps the timestamp (default now) to the start of its window, so that
+    # signatures are the same for the whole window. They are then valid
+    # for at least the 15 minutes allowed by S3 minus the window.
+    window = int(window)
+    if not 0 < window < MAX_CACHE_TTL:
+        raise Exception('window must be between 1 and %d seconds.'
+                        % (MAX_CACHE_TTL - 1))
+    if timestamp:
+        epoch = calendar.timegm(timestamp.timetuple())
+    else:
+        epoch = int(time.time())
+    return _utcfromtimestamp(epoch - epoch % window)
+
+
+def _check_filename(filename):
+    # Filenames are either str or UTF-8 encoded bytes, which quote takes
+    # as they are.
+    if not filename:
+        raise Exception('No filename provided')
+    filename = filename.strip()
+    if filename[:1] not in ('/', b'/'):
+        raise Exception('The filename must starts with the character "/".')
+    return filename
+
+
+def _filepath(bucket_name, filename):
+    if isinstance(filename, bytes):
+        return b'/' + bucket_name.encode('utf-8') + filename
+    return '/' + bucket_name + filename
+
+
+def _check_bucket_name(bucket_name):
+    if bucket_name.startswith('/') or bucket_name.endswith('/'):
+        raise Exception('BUCKET_NAME must neither start nor end with the \
+                         character "/".')
+    return bucket_name
+
+
+def _get_bucket_name(default_bucket_name, options):
+    bucket_name = options.get('bucket_name')
+    if default_bucket_name and bucket_name:
+        raise Exception('Bucket name already set when instantiating \
+                         the class (%s).' % default_bucket_name)
+    elif not default_bucket_name and not bucket_name:
+        raise Exception('Bucket name neither set when instantiating \
+                         the class or calling this method.')
+    elif not bucket_name:
+        bucket_name = default_bucket_name
+    return bucket_name.strip()
+
+
+def _b64(digest):
+    # b2a_base64 gives the same result as base64.b64encode, minus its
+    # argument checks and translation machinery.
+    return binascii.b2a_base64(digest, newline=False).decode('ascii')
+
+
+def _format_signature(aws_key, digest, output, send_headers=None):
+    signature = _b64(digest)
+    if not output:
+        return signature
+    elif output == 'http_header':
+        http_auth_header = "AWS {0}:{1}".format(aws_key, signature)
+        return http_auth_header
+    elif output == 'query_string':
+        return quote(signature)
+    elif output == 'headers':
+        headers = dict(send_headers)
+        headers['Authorization'] = "AWS {0}:{1}".format(aws_key, signature)
+        return headers
+
+
+def _with_token(key, headers):
+    # Temporary credentials are only accepted along with their session
+    # token, which is signed as any other x-amz-* header.
+    if key.SESSION_TOKEN is None:
+        return headers
+    headers = dict(headers or {})
+    headers['x-amz-security-token'] = key.SESSION_TOKEN
+    return headers
+
+
+def _send_headers(timestamp_str, mime_type, headers):
+    # Headers to send along with the Authorization one, for the headers
+    # output.
+    send_headers = dict(headers or {})
+    if mime_type:
+        send_headers['Content-Type'] = mime_type
+    send_headers['x-amz-date'] = timestamp_str
+    return send_headers
+
+
+def _escape(value):
+    return value.replace('{', '{{').replace('}', '}}')
+
+
+def _compile_headers(names):
+    content_md5 = ''
+    content_type = '{1}'
+    amz_headers = {'x-amz-date': ['{3}']}
+    for position, name in enumerate(names):
+        name = name.strip().lower()
+        slot = '{%d}' % (position + 5)
+        if name == 'content-md5':
+            content_md5 = slot
+        elif name == 'content-type':
+            content_type = slot
+        elif name.startswith('x-amz-') and name != 'x-amz-date':
+            # The date is always the one of the signature
+            amz_headers.setdefault(name, []).append(slot)
+    lines = []
+    for name in sorted(amz_headers):
+        if name == 'x-amz-date':
+            # The argument holds the whole line, or nothing.
+            lines.append('{3}')
+        else:
+            lines.append('{0}:{1}\n'.format(_escape(name),
+                                            ','.join(amz_headers[name])))
+    return '{0}\n%s\n%s\n{2}\n%s{4}' % (content_md5, content_type,
+                                        ''.join(lines))
+
+
+def _headers_template(headers):
+    # Returns the string to sign template for these headers, along with
+    # the header values to format it with.
+    if not headers:
+        return _PLAIN_TEMPLATE, ()
+    names = tuple(headers)
+    template = _header_templates.get(names)
+    if template is None:
+        template = _compile_headers(names)
+        _header_templates.set(names, template)
+    return template, [str(value).strip() for value in headers.values()]
+
+
+def _compile_sub_resources(shape):
+    signed = []
+    query = []
+    # Sub-resources are signed sorted by name
+    for position, (name, has_value) in sorted(enumerate(shape),
+                                              key=lambda item: item[1][0]):
+        quoted_name = _escape(quote(name, safe=''))
+        if has_value:
+            signed.append('%s={%d}' % (_escape(name), position))
+            query.append('%s={%d}&' % (quoted_name, position))
+        else:
+            signed.append(_escape(name))
+            query.append(quoted_name + '&')
+    return '?' + '&'.join(signed), ''.join(query)
+
+
+def _sub_resources(sub_resources):
+    # Returns the suffix of the resource to sign and the matching (URI
+    # encoded) query string parameters.
+    if not sub_resources:
+        return '', ''
+    shape = tuple((name, value is not None)
+                  for name, value in sub_resources.items())
+    template = _resource_templates.get(shape)
+    if template is None:
+        template = _compile_sub_resources(shape)
+        _resource_templates.set(shape, template)
+    values = list(sub_resources.values())
+    return (template[0].format(*values),
+            template[1].format(*[quote(str(value), safe='')
+                                 for value in values]))
+
+
+def _freeze(value):
+    # Hashable equivalent of a policy condition, to look its template up.
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((name, _freeze(item))
+                                   for name, item in value.items())))
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(_freeze(item) for item in value))
+    # True, 1 and 1.0 are equal but are not serialized the same.
+    return (type(value), value)
+
+
+def _policy_template(bucket_name, conditions):
+    cache_key = (bucket_name, _freeze(conditions))
+    template = _policy_templates.get(cache_key)
+    if template is not None:
+        return template
+    separators = (',', ':')
+    fields = {}
+    serialized = []
+    for condition in conditions:
+        if isinstance(condition, dict):
+            # Exact matches must also be sent as form fields.
+            fields.update(condition)
+        elif not isinstance(condition, (list, tuple)):
+            raise Exception('A policy condition must be either a dict or a '
+                            'list.')
+        serialized.append(json.dumps(condition, separators=separators))
+    # The policy document is kept as the pieces found around the expiration
+    # date and the key prefix, which change on every form.
+    template = ('{"expiration":"',
+                '","conditions":[' +
+                json.dumps({'bucket': bucket_name}, separators=separators) +
+                ',["starts-with","$key",',
+                ']' + ''.join(',' + item for item in serialized) + ']}',
+                fields)
+    _policy_templates.set(cache_key, template)
+    return template
+
+
+def _string_to_sign(method, filepath, date_header_value, mime_type,
+                    headers=None, sub_resources=None):
+    sanitized_filepath = quote(filepath)
+    if headers or sub_resources:
+        template, values = _headers_template(headers)
+        resource = sanitized_filepath + _sub_resources(sub_resources)[0]
+        return template.format(method, mime_type, '',
+                               date_header_value + '\n', resource, *values)
+    s3_req_string = "{0}\n\n{1}\n\n{2}\n{3}".format(method, mime_type,
+                                                    date_header_value,
+                                                    sanitized_filepath)
+    return s3_req_string
+
+
+class SigningKey(object):
+
+    # Slots keep each key down to a few hundred bytes, see the
+    # ``SignerRegistry`` documentation for the measured footprint.
+    __slots__ = ('AWS_KEY', 'AWS_SECRET_KEY', 'BUCKET_NAME',
+                 'SESSION_TOKEN', '_inner', '_outer')
+
+    def __init__(self, AWS_KEY=None, AWS_SECRET_KEY=None, BUCKET_NAME=None,
+                 SESSION_TOKEN=None):
+        if not AWS_KEY or not AWS_SECRET_KEY:
+            raise Exception('You must provide your AWS key and secret key.')
+        self.AWS_KEY = AWS_KEY
+        self.AWS_SECRET_KEY = AWS_SECRET_KEY
+        self.BUCKET_NAME = BUCKET_NAME and _check_bucket_name(BUCKET_NAME)
+        self.SESSION_TOKEN = SESSION_TOKEN or None
+        # The inner and outer padded key blocks only depend on the secret,
+        # so they are hashed once here and cloned for each signature. The
+        # secret is only encoded here.
+        key = AWS_SECRET_KEY
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        if len(key) > _HMAC_BLOCK_SIZE:
+            key = hashlib.sha1(key).digest()
+        key = key.ljust(_HMAC_BLOCK_SIZE, b'\0')
+        self._inner = hashlib.sha1(key.translate(_TRANS_36))
+        self._outer = hashlib.sha1(key.translate(_TRANS_5C))
+
+    def digest(self, message):
+        inner = self._inner.copy()
+        inner.update(message)
+        outer = self._outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+    def digester(self, prefix):
+        # Returns the digest function of the messages starting with prefix,
+        # which is hashed once here for all of them.
+        prefixed = self._inner.copy()
+        prefixed.update(prefix)
+        outer_state = self._outer
+
+        def digest(message):
+            inner = prefixed.copy()
+            inner.update(message)
+            outer = outer_state.copy()
+            outer.update(inner.digest())
+            return outer.digest()
+        return digest
+
+
+def _forge_signature(key, method, filepath, timestamp=None, output=None,
+                     mime_type=None, headers=None, sub_resources=None):
+    if not timestamp:
+        timestamp = _utcnow()
+    timestamp_str, date_header_value = _format_date(timestamp)
+    headers = _with_token(key, headers)
+    s3_req_string = _string_to_sign(method, filepath, date_header_value,
+                                    mime_type, headers, sub_resources)
+    send_headers = None
+    if output == 'headers':
+        send_headers = _send_headers(timestamp_str, mime_type, headers)
+    return _format_signature(key.AWS_KEY,
+                             key.digest(s3_req_string.encode('utf-8')),
+                             output, send_headers)
+
+
+class _SignerBase(object):
+
+    metrics = None
+
+    def __init__(self, AWS_KEY=None, AWS_SECRET_KEY=None, BUCKET_NAME=None,
+                 METRICS=None, SESSION_TOKEN=None):
         if not AWS_KEY or not AWS_SECRET_KEY:
             raise Exception('You must provide your AWS key and secret key.')
         else:
-            self.AWS_KEY = AWS_KEY
-            self.AWS_SECRET_KEY = AWS_SECRET_KEY
-        # Getting the bucket name if any
+            # Getting the bucket name if any
+            self._set_credentials(AWS_KEY, AWS_SECRET_KEY,
+                                  BUCKET_NAME and
+                                  _check_bucket_name(BUCKET_NAME) or None,
+                                  SESSION_TOKEN)
+        # Optional SigningMetrics instance
+        self.metrics = METRICS
+
+    def rotate_credentials(self, AWS_KEY=None, AWS_SECRET_KEY=None,
+                           BUCKET_NAME=None, SESSION_TOKEN=None):
+        # Signers keep their credentials in a single immutable state object,
+        # which their _set_credentials builds aside then swaps in with one
+        # assignment: a signature is made with either the old or the new
+        # credentials, never a mix of both, and signing needs no lock. The
+        # session token of temporary credentials is part of that state.
+        if not AWS_KEY or not AWS_SECRET_KEY:
+            raise Exception('You must provide your AWS key and secret key.')
         if BUCKET_NAME:
-            if BUCKET_NAME.startswith('/') or BUCKET_NAME.endswith('/'):
-                raise Exception('BUCKET_NAME must neither start nor end with the \
-                                 character "/".')
-            else:
-                self.has_bucket_name = True
-                self.BUCKET_NAME = BUCKET_NAME
+            bucket_name = _check_bucket_name(BUCKET_NAME)
         else:
-            self.has_bucket_name = False
+            bucket_name = self.BUCKET_NAME
+        self._set_credentials(AWS_KEY, AWS_SECRET_KEY, bucket_name,
+                              SESSION_TOKEN)
 
-    def _forge_signature(self, method, filepath, timestamp='', output=None,
-                         mime_type=''):
-        # TODO: Need to type check timestamp for datetime object
-        if not timestamp:
-            timestamp = datetime.now()
-        timestamp_str = datetime.strftime(timestamp,
-                                          '%a, %d %b %Y %H:%M:%S GMT')
-        sanitized_filepath = urllib.quote(filepath)
-        date_header_value = 'x-amz-date:' + timestamp_str
-        s3_req_string = "{0}\n\n{1}\n\n{2}\n{3}".format(method, mime_type,
-                                                        date_header_value,
-                                                        sanitized_filepath)
-        h = hmac.new(self.AWS_SECRET_KEY, s3_req_string, sha)
-        signature = base64.encodestring(h.digest()).strip()
-        if not output:
-            return signature
-        elif output == 'http_header':
-            http_auth_header = "AWS {0}:{1}".format(self.AWS_KEY, signature)
-            return http_auth_header
-        elif output == 'query_string':
-            return urllib.quote(signature)
+    def _check_filename(self, filename):
+        return _check_filename(filename)
 
-    def _sign_operation(self, method, filename, options):
-        if not filename:
-            raise Exception('No filename provided')
-        elif not filename.strip().startswith('/'):
-            raise Exception('The filename must starts with the character "/".')
-        # Get the bucket name
-        bucket_name = options.get('bucket_name')
-        if self.has_bucket_name and bucket_name:
-            raise Exception('Bucket name already set when instantiating \
-                             the class (%s).' % self.BUCKET_NAME)
-        elif not self.has_bucket_name and not bucket_name:
-            raise Exception('Bucket name neither set when instantiating \
-                             the class or calling this method.')
-        elif not bucket_name:
-            bucket_name = self.BUCKET_NAME
-        # Forge signature
-        filepath = "/{0}{1}".format(bucket_name.strip(), filename.strip())
-        forged_sig = self._forge_signature(method, filepath,
-                                           timestamp=options.get('timestamp'),
-                                           output=options.get('output'),
-                                           mime_type=options.get('mime_type'))
-        return forged_sig
+    def _timed_operation(self, operation, method, filename, options):
+        # Only used when metrics are enabled, the signing methods otherwise
+        # only pay for the ``self.metrics`` lookup.
+        metrics = self.metrics
+        started = metrics.timer()
+        try:
+            signature = self._sign_operation(method, filename, options)
+        except Exception:
+            metrics.record(operation, options.get('output'),
+                           metrics.timer() - started, error=True)
+            raise
+        metrics.record(operation, options.get('output'),
+                       metrics.timer() - started)
+        return signature
 
     def sign_get_file(self, filename, **kwargs):
+        if self.metrics is not None:
+            return self._timed_operation('sign_get_file', 'GET', filename,
+                                         kwargs)
         return self._sign_operation('GET', filename, kwargs)
 
     def sign_put_file(self, filename, **kwargs):
+        if self.metrics is not None:
+            return self._timed_operation('sign_put_file', 'PUT', filename,
+                                         kwargs)
         return self._sign_operation('PUT', filename, kwargs)
 
     def sign_delete_file(self, filename, **kwargs):
+        if self.metrics is not None:
+            return self._timed_operation('sign_delete_file', 'DELETE',
+                                         filename, kwargs)
         return self._sign_operation('DELETE', filename, kwargs)
 
     def sign_list_dir(self, directory, **kwargs):
+        if self.metrics is not None:
+            return self._timed_operation('sign_list_dir', 'GET', directory,
+                                         kwargs)
         return self._sign_operation('GET', directory, kwargs)
+
+
+class S3SignedURL(_SignerBase):
+
+    _cache = None
+
+    def __init__(self, AWS_KEY=None, AWS_SECRET_KEY=None, BUCKET_NAME=None,
+                 CACHE_SIZE=None, CACHE_TTL=MAX_CACHE_TTL, METRICS=None,
+                 SESSION_TOKEN=None):
+        super(S3SignedURL, self).__init__(AWS_KEY=AWS_KEY,
+                                          AWS_SECRET_KEY=AWS_SECRET_KEY,
+                                          BUCKET_NAME=BUCKET_NAME,
+                                          METRICS=METRICS,
+                                          SESSION_TOKEN=SESSION_TOKEN)
+        # Opt-in cache of the signatures already forged
+        if CACHE_SIZE:
+            if not 0 < CACHE_TTL <= MAX_CACHE_TTL:
+                raise Exception('CACHE_TTL must be between 0 and %d seconds.'
+                                % MAX_CACHE_TTL)
+            self._cache = LRUCache(CACHE_SIZE, ttl=CACHE_TTL)
+            if METRICS is not None:
+                METRICS.track_cache('signatures', self._cache)
+
+    def _set_credentials(self, aws_key, aws_secret_key, bucket_name=None,
+                         session_token=None):
+        # Signing methods read self._key once, and only use that state.
+        self._key = SigningKey(aws_key, aws_secret_key, bucket_name,
+                               session_token)
+        if self._cache is not None:
+            # Entries are keyed by SigningKey, the old ones can not be hit
+            # anymore.
+            self._cache.clear()
+
+    @property
+    def AWS_KEY(self):
+        return self._key.AWS_KEY
+
+    @AWS_KEY.setter
+    def AWS_KEY(self, value):
+        key = self._key
+        self._set_credentials(value, key.AWS_SECRET_KEY, key.BUCKET_NAME,
+                              key.SESSION_TOKEN)
+
+    @property
+    def AWS_SECRET_KEY(self):
+        return self._key.AWS_SECRET_KEY
+
+    @AWS_SECRET_KEY.setter
+    def AWS_SECRET_KEY(self, value):
+        key = self._key
+        self._set_credentials(key.AWS_KEY, value, key.BUCKET_NAME,
+                              key.SESSION_TOKEN)
+
+    @property
+    def BUCKET_NAME(self):
+        return self._key.BUCKET_NAME
+
+    @property
+    def SESSION_TOKEN(self):
+        return self._key.SESSION_TOKEN
+
+    @property
+    def has_bucket_name(self):
+        return bool(self._key.BUCKET_NAME)
+
+    @property
+    def cache_hits(self):
+        return self._cache.hits if self._cache is not None else 0
+
+    @property
+    def cache_misses(self):
+        return self._cache.misses if self._cache is not None else 0
+
+    def _forge_signature(self, method, filepath, timestamp='', output=None,
+                         mime_type='', headers=None, sub_resources=None,
+                         key=None):
+        # TODO: Need to type check timestamp for datetime object
+        if not timestamp:
+            timestamp = _utcnow()
+        if key is None:
+            key = self._key
+        cache = self._cache
+        if cache is None:
+            return _forge_signature(key, method, filepath, timestamp, output,
+                                    mime_type, headers, sub_resources)
+        timestamp_str = _format_date(timestamp)[0]
+        cache_key = (key, method, filepath, mime_type, output, timestamp_str,
+                     headers and tuple(sorted(headers.items())),
+                     sub_resources and tuple(sorted(sub_resources.items())))
+        signature = cache.get(cache_key)
+        if signature is None:
+            signature = _forge_signature(key, method, filepath, timestamp,
+                                         output, mime_type, headers,
+                                         sub_resources)
+            cache.set(cache_key, signature)
+        if output == 'headers':
+            # Cached dictionaries must not be changed by callers.
+            return dict(signature)
+        return signature
+
+    def _sign_operation(self, method, filename, options):
+        filename = self._check_filename(filename)
+        key = self._key
+        # Get the bucket name
+        bucket_name = _get_bucket_name(key.BUCKET_NAME, options)
+        # Forge signature
+        filepath = _filepath(bucket_name, filename)
+        timestamp = options.get('timestamp')
+        if options.get('window'):
+            timestamp = _window_start(timestamp, options['window'])
+        forged_sig = self._forge_signature(
+            method, filepath, timestamp=timestamp,
+            output=options.get('output'), mime_type=options.get('mime_type'),
+            headers=options.get('headers'),
+            sub_resources=options.get('sub_resources'), key=key)
+        return forged_sig
+
+    def iter_sign(self, method, filenames, **kwargs):
+        # Options apply to the whole batch: the bucket name is resolved
+        # and the timestamp formatted once for all the filenames.
+        key = self._key
+        bucket_name = _get_bucket_name(key.BUCKET_NAME, kwargs)
+        timestamp = kwargs.get('timestamp')
+        if kwargs.get('window'):
+            timestamp = _window_start(timestamp, kwargs['window'])
+        elif not timestamp:
+            timestamp = _utcnow()
+        timestamp_str, date_header_value = _format_date(timestamp)
+        output = kwargs.get('output')
+        headers = _with_token(key, kwargs.get('headers'))
+        send_headers = None
+        if output == 'headers':
+            send_headers = _send_headers(timestamp_str,
+                                         kwargs.get('mime_type'), headers)
+        # quote works character by character, so quoting the bucket prefix
+        # once and the filename separately gives the same result. The prefix
+        # of the string to sign is only hashed once for the whole batch.
+        template, values = _headers_template(headers)
+        req_prefix = template.format(method, kwargs.get('mime_type'), '',
+                                     date_header_value + '\n',
+                                     quote('/' + bucket_name), *values)
+        req_suffix = _sub_resources(
+            kwargs.get('sub_resources'))[0].encode('utf-8')
+        aws_key = key.AWS_KEY
+        digest = key.digester(req_prefix.encode('utf-8'))
+        for filename in filenames:
+            quoted_filename = quote(_check_filename(filename)).encode()
+            yield _format_signature(aws_key,
+                                    digest(quoted_filename + req_suffix),
+                                    output, send_headers)
+
+    def sign_many(self, method, filenames, **kwargs):
+        return list(self.iter_sign(method, filenames, **kwargs))
+
+    def _presign_context(self, method, expires_in, host_style, options):
+        key = self._key
+        bucket_name = _get_bucket_name(key.BUCKET_NAME, options)
+        if host_style not in ('virtual', 'path'):
+            raise Exception('host_style must be either "virtual" or "path".')
+        timestamp = options.get('timestamp')
+        if timestamp:
+            epoch = calendar.timegm(timestamp.timetuple())
+        else:
+            epoch = int(time.time())
+        expires = epoch + int(expires_in)
+        # Number of seconds the same URLs keep being given
+        stable_for = None
+        window = options.get('window')
+        if window:
+            # Expiry dates are rounded up to the end of a window: URLs are
+            # the same for a whole window, and valid for at least
+            # expires_in seconds.
+            window = int(window)
+            if window < 1:
+                raise Exception('window must be a positive number of '
+                                'seconds.')
+            expires += -expires % window
+            stable_for = expires - int(expires_in) - epoch
+        expires = str(expires)
+        endpoint = options.get('endpoint') or DEFAULT_ENDPOINT
+        scheme = options.get('scheme') or 'https'
+        path_prefix = quote('/' + bucket_name)
+        # Query string authentication signs the Expires value in place of
+        # the date, and S3 expects an empty Content-Type when none is sent.
+        template, values = _headers_template(
+            _with_token(key, options.get('headers')))
+        req_prefix = template.format(method, options.get('mime_type') or '',
+                                     expires, '', path_prefix, *values)
+        if host_style == 'virtual':
+            url_prefix = '{0}://{1}.{2}'.format(scheme, bucket_name, endpoint)
+        else:
+            url_prefix = '{0}://{1}{2}'.format(scheme, endpoint, path_prefix)
+        auth_query = 'AWSAccessKeyId={0}&Expires={1}&'.format(
+            quote(key.AWS_KEY, safe=''), expires)
+        if key.SESSION_TOKEN is not None:
+            auth_query += 'x-amz-security-token={0}&'.format(
+                quote(key.SESSION_TOKEN, safe=''))
+        auth_query += 'Signature='
+        return key, req_prefix, url_prefix, auth_query, stable_for
+
+    def iter_presigned_urls(self, filenames, method='GET',
+                            expires_in=DEFAULT_EXPIRES_IN,
+                            host_style='virtual', **kwargs):
+        key, req_prefix, url_prefix, auth_query, stable_for = \
+            self._presign_context(method, expires_in, host_style, kwargs)
+        signed_suffix, query = _sub_resources(kwargs.get('sub_resources'))
+        query_prefix = '?' + query + auth_query
+        digest = key.digester(req_prefix.encode('utf-8'))
+        encoded_suffix = signed_suffix.encode('utf-8')
+        cache = self._cache
+        if cache is not None and stable_for:
+            # Windowed URLs are memoized for the rest of their window. The
+            # prefixes hold everything the URL depends on, the filename
+            # excepted.
+            cache_prefix = ('url', key, req_prefix, url_prefix, query_prefix,
+                            signed_suffix)
+        else:
+            cache = None
+        for filename in filenames:
+            if cache is not None:
+                cache_key = cache_prefix + (filename,)
+                url = cache.get(cache_key)
+                if url is not None:
+                    yield url
+                    continue
+            quoted_filename = quote(_check_filename(filename))
+            signature = _b64(digest(quoted_filename.encode() +
+                                    encoded_suffix))
+            url = (url_prefix + quoted_filename + query_prefix +
+                   quote(signature, safe=''))
+            if cache is not None:
+                cache.set(cache_key, url, ttl=stable_for)
+            yield url
+
+    def presign_url(self, method, filename, expires_in=DEFAULT_EXPIRES_IN,
+                    host_style='virtual', **kwargs):
+        urls = self.iter_presigned_urls([filename], method=method,
+                                        expires_in=expires_in,
+                                        host_style=host_style, **kwargs)
+        return next(urls)
+
+    def sign_post_policy(self, key_prefix, conditions=None,
+                         expires_in=DEFAULT_EXPIRES_IN, host_style='virtual',
+                         **kwargs):
+        key = self._key
+        bucket_name = _get_bucket_name(key.BUCKET_NAME, kwargs)
+        if host_style not in ('virtual', 'path'):
+            raise Exception('host_style must be either "virtual" or "path".')
+        if key_prefix is None:
+            raise Exception('No key_prefix provided')
+        # Form fields hold object keys, which do not start with a "/".
+        key_prefix = key_prefix.lstrip('/')
+        conditions = list(conditions or ())
+        if key.SESSION_TOKEN is not None:
+            # Sent as a form field, and so matched by the policy.
+            conditions.append({'x-amz-security-token': key.SESSION_TOKEN})
+        head, middle, tail, fields = _policy_template(bucket_name,
+                                                      conditions)
+        timestamp = kwargs.get('timestamp')
+        if timestamp:
+            epoch = calendar.timegm(timestamp.timetuple())
+        else:
+            epoch = int(time.time())
+        expiration = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                   time.gmtime(epoch + int(expires_in)))
+        policy = binascii.b2a_base64((
+            head + expiration + middle + json.dumps(key_prefix) +
+            tail).encode('utf-8'), newline=False)
+        fields = dict(fields)
+        fields['key'] = key_prefix + '${filename}'
+        fields['AWSAccessKeyId'] = key.AWS_KEY
+        fields['policy'] = policy.decode('ascii')
+        fields['signature'] = _b64(key.digest(policy))
+        endpoint = kwargs.get('endpoint') or DEFAULT_ENDPOINT
+        scheme = kwargs.get('scheme') or 'https'
+        if host_style == 'virtual':
+            url = '{0}://{1}.{2}/'.format(scheme, bucket_name, endpoint)
+        else:
+            url = '{0}://{1}/{2}/'.format(scheme, endpoint, bucket_name)
+        return {'url': url, 'fields': fields}
+
+    def plan_multipart_upload(self, filename, size, part_size, upload_id,
+                              expires_in=DEFAULT_EXPIRES_IN,
+                              host_style='virtual', **kwargs):
+        return MultipartUploadPlan(self, filename, size, part_size,
+                                   upload_id, expires_in, host_style, kwargs)
+
+
+SignedPart = namedtuple('SignedPart', 'part_number offset size url')
+
+
+class MultipartUploadPlan(object):
+
+    def __init__(self, signer, filename, size, part_size, upload_id,
+                 expires_in, host_style, options):
+        if size < 0 or part_size < 1:
+            raise Exception('size must be positive and part_size strictly '
+                            'positive.')
+        parts_count = max((size + part_size - 1) // part_size, 1)
+        if parts_count > MAX_PARTS:
+            raise Exception('An upload can not have more than %d parts, use '
+                            'a bigger part_size.' % MAX_PARTS)
+        if parts_count > 1 and part_size < MIN_PART_SIZE:
+            raise Exception('part_size must be at least %d bytes.'
+                            % MIN_PART_SIZE)
+        if not upload_id:
+            raise Exception('No upload_id provided')
+        if options.get('sub_resources'):
+            # The sub-resources are the partNumber and uploadId ones.
+            raise Exception('sub_resources can not be given for a multipart '
+                            'upload.')
+        self.filename = _check_filename(filename)
+        self.size = size
+        self.part_size = part_size
+        self.upload_id = upload_id
+        self._count = parts_count
+        # Parts are uploaded without Content-Type, and share the expiry
+        # date, encoded path and key state computed here.
+        options = dict(options, mime_type=None)
+        options.pop('sub_resources', None)
+        key, req_prefix, url_prefix, auth_query, _ = \
+            signer._presign_context('PUT', expires_in, host_style, options)
+        quoted_filename = quote(self.filename)
+        self._digest = key.digester(
+            (req_prefix + quoted_filename + '?partNumber=').encode('utf-8'))
+        self._signed_suffix = '&uploadId=' + upload_id
+        self._url_prefix = url_prefix + quoted_filename + '?partNumber='
+        self._url_suffix = '&uploadId={0}&{1}'.format(
+            quote(upload_id, safe=''), auth_query)
+        sub_resources = {'uploadId': upload_id}
+        self.complete_url = signer.presign_url(
+            'POST', self.filename, expires_in=expires_in,
+            host_style=host_style, sub_resources=sub_resources, **options)
+        self.abort_url = signer.presign_url(
+            'DELETE', self.filename, expires_in=expires_in,
+            host_style=host_style, sub_resources=sub_resources, **options)
+
+    def __len__(self):
+        return self._count
+
+    def _part(self, index):
+        number = str(index + 1)
+        signature = _b64(self._digest(
+            (number + self._signed_suffix).encode('utf-8')))
+        url = (self._url_prefix + number + self._url_suffix +
+               quote(signature, safe=''))
+        offset = index * self.part_size
+        return SignedPart(index + 1, offset,
+                          min(self.part_size, self.size - offset), url)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._part(i) for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('part index out of range')
+        return self._part(index)
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self._part(index)
+
+
+class SignerRegistry(object):
+
+    def __init__(self):
+        self._keys = {}
+
+    def add(self, AWS_KEY=None, AWS_SECRET_KEY=None, BUCKET_NAME=None,
+            SESSION_TOKEN=None):
+        key = SigningKey(AWS_KEY, AWS_SECRET_KEY, BUCKET_NAME, SESSION_TOKEN)
+        self._keys[AWS_KEY] = key
+        return key
+
+    def remove(self, AWS_KEY):
+        self._keys.pop(AWS_KEY, None)
+
+    def get(self, AWS_KEY):
+        try:
+            return self._keys[AWS_KEY]
+        except KeyError:
+            raise Exception('Unknown AWS key (%s).' % AWS_KEY)
+
+    def find(self, AWS_KEY):
+        # Same as get, but returns None for unknown keys, e.g. the ones
+        # sent by clients.
+        return self._keys.get(AWS_KEY)
+
+    def __contains__(self, AWS_KEY):
+        return AWS_KEY in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def sign(self, AWS_KEY, method, filename, **kwargs):
+        key = self.get(AWS_KEY)
+        filename = _check_filename(filename)
+        bucket_name = _get_bucket_name(key.BUCKET_NAME, kwargs)
+        filepath = _filepath(bucket_name, filename)
+        timestamp = kwargs.get('timestamp')
+        if kwargs.get('window'):
+            timestamp = _window_start(timestamp, kwargs['window'])
+        return _forge_signature(key, method, filepath,
+                                timestamp=timestamp,
+                                output=kwargs.get('output'),
+                                mime_type=kwargs.get('mime_type'),
+                                headers=kwargs.get('headers'),
+                                sub_resources=kwargs.get('sub_resources'))
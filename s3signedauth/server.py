@@ -0,0 +1,317 @@
+import json
+import time
+import socket
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .s3signedauth import (S3SignedURL, DEFAULT_EXPIRES_IN, _format_date,
+                           _utcfromtimestamp)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+# Requests signed within the same time bucket share their timestamp, and
+# so can share their signatures.
+DEFAULT_TIME_BUCKET = 1
+# Batches of at least this many new signatures are sent to the worker
+# pool, smaller ones are signed right away on the event loop.
+DEFAULT_OFFLOAD_THRESHOLD = 1000
+DEFAULT_CHUNK_SIZE = 1000
+# Signatures remembered for the current time bucket.
+MAX_COALESCED = 100000
+MAX_BODY_SIZE = 16 * 1024 * 1024
+MAX_HEADERS_SIZE = 64 * 1024
+OUTPUTS = (None, 'http_header', 'query_string', 'url')
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed', 413: 'Request Entity Too Large',
+            500: 'Internal Server Error'}
+
+# Signer of the worker processes, built once by _init_worker.
+_worker = None
+
+
+def _init_worker(aws_key, aws_secret_key, bucket_name):
+    global _worker
+    _worker = S3SignedURL(AWS_KEY=aws_key, AWS_SECRET_KEY=aws_secret_key,
+                          BUCKET_NAME=bucket_name)
+
+
+def _parse_item(item):
+    # Returns the coalescing key of a sign request: (method, filename,
+    # output, mime_type, bucket_name, expires_in).
+    if not isinstance(item, dict) or not item.get('filename'):
+        raise Exception('Each request must be an object with a filename.')
+    for name in ('filename', 'method', 'mime_type', 'bucket_name'):
+        # The key must be hashable, and the signer only takes strings.
+        if item.get(name) is not None and not isinstance(item[name], str):
+            raise Exception('%s must be a string.' % name)
+    output = item.get('output')
+    if output not in OUTPUTS:
+        raise Exception('output must be one of http_header, query_string '
+                        'or url.')
+    expires_in = item.get('expires_in')
+    if expires_in is not None and (not isinstance(expires_in, int) or
+                                   isinstance(expires_in, bool)):
+        raise Exception('expires_in must be an integer.')
+    expires_in = expires_in or DEFAULT_EXPIRES_IN
+    if output != 'url':
+        expires_in = None
+    return ((item.get('method') or 'GET').upper(), item['filename'], output,
+            item.get('mime_type'), item.get('bucket_name'), expires_in)
+
+
+def _sign_item(signer, key, timestamp):
+    method, filename, output, mime_type, bucket_name, expires_in = key
+    try:
+        if output == 'url':
+            return {'url': signer.presign_url(
+                method, filename, expires_in=int(expires_in),
+                timestamp=timestamp, mime_type=mime_type,
+                bucket_name=bucket_name)}
+        return {'signature': signer._sign_operation(
+            method, filename, {'timestamp': timestamp, 'output': output,
+                               'mime_type': mime_type,
+                               'bucket_name': bucket_name})}
+    except Exception as ex:
+        return {'error': str(ex)}
+
+
+def _sign_chunk(keys, timestamp):
+    return [_sign_item(_worker, key, timestamp) for key in keys]
+
+
+def _response(status, payload, keep_alive):
+    body = json.dumps(payload).encode('utf-8')
+    head = ('HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\n'
+            'Content-Length: {2}\r\n{3}\r\n'.format(
+                status, _REASONS[status], len(body),
+                '' if keep_alive else 'Connection: close\r\n'))
+    return head.encode('latin-1') + body
+
+
+class SigningServer(object):
+
+    def __init__(self, AWS_KEY=None, AWS_SECRET_KEY=None, BUCKET_NAME=None,
+                 HOST=DEFAULT_HOST, PORT=DEFAULT_PORT, WORKERS=None,
+                 TIME_BUCKET=DEFAULT_TIME_BUCKET,
+                 OFFLOAD_THRESHOLD=DEFAULT_OFFLOAD_THRESHOLD,
+                 CHUNK_SIZE=DEFAULT_CHUNK_SIZE):
+        # Also checks the credentials and bucket name
+        self.signer = S3SignedURL(AWS_KEY=AWS_KEY,
+                                  AWS_SECRET_KEY=AWS_SECRET_KEY,
+                                  BUCKET_NAME=BUCKET_NAME)
+        if TIME_BUCKET < 1:
+            raise Exception('TIME_BUCKET must be at least 1 second.')
+        self.TIME_BUCKET = TIME_BUCKET
+        self.OFFLOAD_THRESHOLD = OFFLOAD_THRESHOLD
+        self.CHUNK_SIZE = max(CHUNK_SIZE, 1)
+        self.clock = time.time
+        # Bound here so that the address is known before serving.
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((HOST, PORT))
+        self._socket.listen(128)
+        self._socket.setblocking(False)
+        self.address = self._socket.getsockname()
+        if WORKERS is None:
+            WORKERS = multiprocessing.cpu_count()
+        self._pool = None
+        if WORKERS:
+            self._pool = ProcessPoolExecutor(
+                WORKERS, initializer=_init_worker,
+                initargs=(AWS_KEY, AWS_SECRET_KEY, BUCKET_NAME))
+        # Signatures of the current time bucket, and the futures of the
+        # ones being signed, per (time bucket, key).
+        self._bucket = None
+        self._signed = {}
+        self._pending = {}
+        self._loop = None
+        self._stopped = None
+        self._shutdown_requested = False
+        self._connections = set()
+
+    async def _handle_connection(self, reader, writer):
+        # Requests of a connection are handled one at a time, so that
+        # responses are sent in order.
+        task = asyncio.current_task()
+        self._connections.add((task, writer))
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(_response(413, {
+                        'error': 'Request too large.'}, False))
+                    break
+                status, payload, keep_alive = await self._read_request(
+                    head, reader)
+                writer.write(_response(status, payload, keep_alive))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # The client went away while its request was signed.
+            pass
+        except asyncio.CancelledError:
+            # Closed by shutdown, which waits for this task to end.
+            pass
+        finally:
+            self._connections.discard((task, writer))
+            writer.close()
+
+    async def _read_request(self, head, reader):
+        # Returns the (status, payload, keep_alive) of the response.
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, path, version = lines[0].split()
+            headers = dict((name.strip().lower(), value.strip())
+                           for name, _, value in
+                           (line.partition(':') for line in lines[1:]
+                            if line))
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            return 400, {'error': 'Malformed request.'}, False
+        keep_alive = (version == 'HTTP/1.1' and
+                      headers.get('connection') != 'close')
+        if length < 0 or 'transfer-encoding' in headers:
+            # Chunked bodies are not supported, the connection is closed
+            # so that they are not read as the next request.
+            return 400, {'error': 'A Content-Length is required.'}, False
+        if length > MAX_BODY_SIZE:
+            return 413, {'error': 'Request too large.'}, False
+        body = await reader.readexactly(length) if length else b''
+        status, payload = await self.handle_request(method, path, body)
+        return status, payload, keep_alive
+
+    async def handle_request(self, method, path, body):
+        if path.split('?')[0] != '/sign':
+            return 404, {'error': 'Not found.'}
+        if method != 'POST':
+            return 405, {'error': 'Use POST.'}
+        try:
+            items = json.loads(body)['requests']
+            if not isinstance(items, list):
+                raise ValueError
+        except (ValueError, KeyError, TypeError):
+            return 400, {'error': 'The body must be a JSON object holding a '
+                                  'list of "requests".'}
+        now = int(self.clock())
+        bucket = now - now % self.TIME_BUCKET
+        if bucket != self._bucket:
+            self._bucket = bucket
+            self._signed = {}
+        timestamp = _utcfromtimestamp(bucket)
+        date = _format_date(timestamp)[0]
+        signed = self._signed
+        pending = self._pending
+        loop = asyncio.get_running_loop()
+        results = [None] * len(items)
+        waiting = []
+        new = []
+        try:
+            for index, item in enumerate(items):
+                try:
+                    key = _parse_item(item)
+                except Exception as ex:
+                    results[index] = {'error': str(ex)}
+                    continue
+                result = signed.get(key)
+                if result is not None:
+                    results[index] = result
+                    continue
+                future = pending.get((bucket, key))
+                if future is None:
+                    # Not already being signed, for this or another request.
+                    future = pending[bucket, key] = loop.create_future()
+                    new.append(key)
+                waiting.append((index, future))
+            if self._pool is not None and len(new) >= self.OFFLOAD_THRESHOLD:
+                for start in range(0, len(new), self.CHUNK_SIZE):
+                    keys = new[start:start + self.CHUNK_SIZE]
+                    self._offload(loop, keys, timestamp, bucket)
+            elif new:
+                self._resolve(new, [_sign_item(self.signer, key, timestamp)
+                                    for key in new], bucket)
+        except Exception as ex:
+            # Other requests may be waiting for the futures created here.
+            self._resolve(new, [{'error': str(ex)}] * len(new), bucket)
+            return 500, {'error': 'Internal error.'}
+        for index, future in waiting:
+            results[index] = await future
+        return 200, {'x-amz-date': date, 'results': results}
+
+    def _offload(self, loop, keys, timestamp, bucket):
+        try:
+            future = loop.run_in_executor(self._pool, _sign_chunk, keys,
+                                          timestamp)
+        except Exception as ex:
+            # e.g. a BrokenProcessPool, once a worker process died
+            self._resolve(keys, [{'error': str(ex)}] * len(keys), bucket)
+        else:
+            future.add_done_callback(self._callback(keys, bucket))
+
+    def _callback(self, keys, bucket):
+        def callback(future):
+            exception = future.exception()
+            if exception is not None:
+                # e.g. a worker process died
+                results = [{'error': str(exception)}] * len(keys)
+            else:
+                results = future.result()
+            self._resolve(keys, results, bucket)
+        return callback
+
+    def _resolve(self, keys, results, bucket):
+        same_bucket = bucket == self._bucket
+        if same_bucket and len(self._signed) + len(keys) > MAX_COALESCED:
+            self._signed = {}
+        for key, result in zip(keys, results):
+            if same_bucket and 'error' not in result:
+                self._signed[key] = result
+            future = self._pending.pop((bucket, key), None)
+            if future is not None and not future.done():
+                future.set_result(result)
+
+    async def _serve(self):
+        server = await asyncio.start_server(
+            self._handle_connection, sock=self._socket,
+            limit=MAX_HEADERS_SIZE)
+        try:
+            await self._stopped
+        finally:
+            server.close()
+            for task, writer in list(self._connections):
+                writer.close()
+                task.cancel()
+            tasks = [task for task, _ in self._connections]
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await server.wait_closed()
+
+    def serve_forever(self):
+        loop = asyncio.new_event_loop()
+        self._stopped = loop.create_future()
+        self._loop = loop
+        if self._shutdown_requested:
+            self._stop()
+        try:
+            loop.run_until_complete(self._serve())
+        finally:
+            self._loop = None
+            loop.close()
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+    def shutdown(self):
+        # May be called from any thread, serve_forever returns once all the
+        # connections are closed.
+        self._shutdown_requested = True
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._stop)
+
+    def _stop(self):
+        if not self._stopped.done():
+            self._stopped.set_result(None)
@@ -0,0 +1,357 @@
+import hmac
+import hashlib
+from collections import namedtuple
+from urllib.parse import quote
+
+from .cache import LRUCache
+from .s3signedauth import (_SignerBase, DEFAULT_EXPIRES_IN,
+                           _get_bucket_name, _utcnow, _window_start)
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+EMPTY_PAYLOAD_HASH = hashlib.sha256(b'').hexdigest()
+DEFAULT_REGION = 'us-east-1'
+# Derived signing keys are only valid for one day, so a handful of
+# (date, region, service) entries is enough for a long running process.
+DEFAULT_KEY_CACHE_SIZE = 16
+# aws-chunked uploads, see "Signature Calculations for the Authorization
+# Header: Transferring Payload in Multiple Chunks".
+STREAMING_PAYLOAD = 'STREAMING-AWS4-HMAC-SHA256-PAYLOAD'
+CHUNK_ALGORITHM = 'AWS4-HMAC-SHA256-PAYLOAD'
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# S3 rejects chunks smaller than 8KB, the last one excepted.
+MIN_CHUNK_SIZE = 8 * 1024
+
+
+_Credentials = namedtuple('_Credentials',
+                          'AWS_KEY AWS_SECRET_KEY BUCKET_NAME SESSION_TOKEN')
+
+
+def _uri_encode(value, safe='~'):
+    # SigV4 URI encoding: only unreserved characters are left as is.
+    return quote(value, safe=safe)
+
+
+def _format_amz_date(timestamp):
+    amz_date = '%04d%02d%02dT%02d%02d%02dZ' % (
+        timestamp.year, timestamp.month, timestamp.day, timestamp.hour,
+        timestamp.minute, timestamp.second)
+    return amz_date, amz_date[:8]
+
+
+def _canonical_query_string(query):
+    if not query:
+        return ''
+    params = sorted((_uri_encode(str(name)), _uri_encode(str(value or '')))
+                    for name, value in query.items())
+    return '&'.join('%s=%s' % param for param in params)
+
+
+def _chunk_length(size):
+    # "<hex size>;chunk-signature=<64 hex digits>\r\n<data>\r\n"
+    return len('%x' % size) + 17 + 64 + 2 + size + 2
+
+
+def _encoded_length(content_length, chunk_size):
+    full, rest = divmod(content_length, chunk_size)
+    length = full * _chunk_length(chunk_size) + _chunk_length(0)
+    if rest:
+        length += _chunk_length(rest)
+    return length
+
+
+def _iter_chunks(payload, chunk_size):
+    # Yields memoryviews of chunk_size bytes (the last one may be smaller).
+    # Chunks are read into a new buffer each, rather than a shared one, so
+    # that they stay valid when the body is collected before being sent.
+    view = memoryview(bytearray(chunk_size))
+    filled = 0
+    readinto = getattr(payload, 'readinto', None)
+    if readinto is not None:
+        while True:
+            while filled < chunk_size:
+                count = readinto(view[filled:])
+                if not count:
+                    break
+                filled += count
+            if filled < chunk_size:
+                break
+            yield view
+            view = memoryview(bytearray(chunk_size))
+            filled = 0
+    else:
+        for data in payload:
+            data = memoryview(data)
+            size = len(data)
+            start = 0
+            while start < size:
+                if not filled and size - start >= chunk_size:
+                    # Whole chunks are signed in place, without a copy.
+                    yield data[start:start + chunk_size]
+                    start += chunk_size
+                    continue
+                count = min(chunk_size - filled, size - start)
+                view[filled:filled + count] = data[start:start + count]
+                filled += count
+                start += count
+                if filled == chunk_size:
+                    yield view
+                    view = memoryview(bytearray(chunk_size))
+                    filled = 0
+    if filled:
+        yield view[:filled]
+
+
+class S3SignedURLV4(_SignerBase):
+
+    def __init__(self, AWS_KEY=None, AWS_SECRET_KEY=None, BUCKET_NAME=None,
+                 REGION=DEFAULT_REGION, KEY_CACHE_SIZE=DEFAULT_KEY_CACHE_SIZE,
+                 METRICS=None, SESSION_TOKEN=None):
+        self._signing_keys = LRUCache(KEY_CACHE_SIZE)
+        super(S3SignedURLV4, self).__init__(AWS_KEY=AWS_KEY,
+                                            AWS_SECRET_KEY=AWS_SECRET_KEY,
+                                            BUCKET_NAME=BUCKET_NAME,
+                                            METRICS=METRICS,
+                                            SESSION_TOKEN=SESSION_TOKEN)
+        if METRICS is not None:
+            METRICS.track_cache('signing_keys', self._signing_keys)
+        if not REGION:
+            raise Exception('REGION must not be empty.')
+        self.REGION = REGION
+
+    def _set_credentials(self, aws_key, aws_secret_key, bucket_name=None,
+                         session_token=None):
+        # Swapped as a whole, see _SignerBase.rotate_credentials
+        self._credentials = _Credentials(aws_key, aws_secret_key, bucket_name,
+                                         session_token or None)
+
+    @property
+    def AWS_KEY(self):
+        return self._credentials.AWS_KEY
+
+    @AWS_KEY.setter
+    def AWS_KEY(self, value):
+        self._credentials = self._credentials._replace(AWS_KEY=value)
+
+    @property
+    def AWS_SECRET_KEY(self):
+        return self._credentials.AWS_SECRET_KEY
+
+    @AWS_SECRET_KEY.setter
+    def AWS_SECRET_KEY(self, value):
+        self._credentials = self._credentials._replace(AWS_SECRET_KEY=value)
+
+    @property
+    def BUCKET_NAME(self):
+        return self._credentials.BUCKET_NAME
+
+    @property
+    def SESSION_TOKEN(self):
+        return self._credentials.SESSION_TOKEN
+
+    @property
+    def has_bucket_name(self):
+        return bool(self._credentials.BUCKET_NAME)
+
+    def _signing_key(self, datestamp, region, service='s3', secret_key=None):
+        # Deriving the key takes four HMACs, the result is the same for a
+        # whole day so it is kept in a small LRU cache. Keys derived from a
+        # rotated secret key are left to expire from it.
+        if secret_key is None:
+            secret_key = self._credentials.AWS_SECRET_KEY
+        cache_key = (secret_key, datestamp, region, service)
+        signing_key = self._signing_keys.get(cache_key)
+        if signing_key is None:
+            # The secret key is only encoded when a new key is derived.
+            if isinstance(secret_key, str):
+                secret_key = secret_key.encode('utf-8')
+            k_date = hmac.new(b'AWS4' + secret_key, datestamp.encode(),
+                              hashlib.sha256).digest()
+            k_region = hmac.new(k_date, region.encode(),
+                                hashlib.sha256).digest()
+            k_service = hmac.new(k_region, service.encode(),
+                                 hashlib.sha256).digest()
+            signing_key = hmac.new(k_service, b'aws4_request',
+                                   hashlib.sha256).digest()
+            self._signing_keys.set(cache_key, signing_key)
+        return signing_key
+
+    def _host(self, bucket_name, options):
+        endpoint = options.get('endpoint')
+        if not endpoint:
+            if self.REGION == DEFAULT_REGION:
+                endpoint = 's3.amazonaws.com'
+            else:
+                endpoint = 's3.{0}.amazonaws.com'.format(self.REGION)
+        host_style = options.get('host_style') or 'virtual'
+        if host_style == 'virtual':
+            return '{0}.{1}'.format(bucket_name, endpoint), ''
+        elif host_style == 'path':
+            return endpoint, '/' + bucket_name
+        raise Exception('host_style must be either "virtual" or "path".')
+
+    def _forge_signature(self, method, canonical_uri, host, timestamp=None,
+                         output=None, mime_type=None, headers=None,
+                         query=None, payload_hash=UNSIGNED_PAYLOAD,
+                         expires_in=DEFAULT_EXPIRES_IN, credentials=None):
+        if not timestamp:
+            timestamp = _utcnow()
+        if credentials is None:
+            credentials = self._credentials
+        aws_key = credentials.AWS_KEY
+        amz_date, datestamp = _format_amz_date(timestamp)
+        scope = '{0}/{1}/s3/aws4_request'.format(datestamp, self.REGION)
+        signed = {'host': host}
+        for name, value in (headers or {}).items():
+            signed[name.lower()] = ' '.join(str(value).split())
+        if mime_type:
+            signed['content-type'] = mime_type
+        query = dict(query or {})
+        token = credentials.SESSION_TOKEN
+        if output in ('query_string', 'url'):
+            # Presigned requests carry the authentication in the query
+            # string and can not know the payload in advance.
+            payload_hash = UNSIGNED_PAYLOAD
+            if token is not None:
+                query['X-Amz-Security-Token'] = token
+        else:
+            signed['x-amz-date'] = amz_date
+            signed['x-amz-content-sha256'] = payload_hash
+            if token is not None:
+                signed['x-amz-security-token'] = token
+        names = sorted(signed)
+        signed_headers = ';'.join(names)
+        if output in ('query_string', 'url'):
+            query.update({
+                'X-Amz-Algorithm': ALGORITHM,
+                'X-Amz-Credential': '{0}/{1}'.format(aws_key, scope),
+                'X-Amz-Date': amz_date,
+                'X-Amz-Expires': str(int(expires_in)),
+                'X-Amz-SignedHeaders': signed_headers})
+        canonical_query = _canonical_query_string(query)
+        canonical_headers = ''.join('{0}:{1}\n'.format(name, signed[name])
+                                    for name in names)
+        canonical_request = '\n'.join([method, canonical_uri, canonical_query,
+                                       canonical_headers, signed_headers,
+                                       payload_hash])
+        string_to_sign = '\n'.join([
+            ALGORITHM, amz_date, scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+        signing_key = self._signing_key(datestamp, self.REGION,
+                                        secret_key=credentials.AWS_SECRET_KEY)
+        signature = hmac.new(signing_key, string_to_sign.encode(),
+                             hashlib.sha256).hexdigest()
+        if not output:
+            return signature
+        elif output in ('http_header', 'headers'):
+            authorization = '{0} Credential={1}/{2}, SignedHeaders={3}, ' \
+                            'Signature={4}'.format(ALGORITHM, aws_key,
+                                                   scope, signed_headers,
+                                                   signature)
+            if output == 'http_header':
+                return authorization
+            result = dict(headers or {})
+            if mime_type:
+                result['Content-Type'] = mime_type
+            result.update({'Host': host,
+                           'x-amz-date': amz_date,
+                           'x-amz-content-sha256': payload_hash,
+                           'Authorization': authorization})
+            if token is not None:
+                result['x-amz-security-token'] = token
+            return result
+        query_string = '{0}&X-Amz-Signature={1}'.format(canonical_query,
+                                                        signature)
+        if output == 'query_string':
+            return query_string
+        return 'https://{0}{1}?{2}'.format(host, canonical_uri, query_string)
+
+    def _sign_operation(self, method, filename, options, credentials=None):
+        filename = self._check_filename(filename)
+        if credentials is None:
+            credentials = self._credentials
+        bucket_name = _get_bucket_name(credentials.BUCKET_NAME, options)
+        host, path_prefix = self._host(bucket_name, options)
+        # Filenames may be UTF-8 encoded bytes, quoted apart from the str
+        # prefix.
+        canonical_uri = (_uri_encode(path_prefix, safe='/~') +
+                         _uri_encode(filename, safe='/~'))
+        payload_hash = options.get('payload_hash') or UNSIGNED_PAYLOAD
+        timestamp = options.get('timestamp')
+        expires_in = options.get('expires_in') or DEFAULT_EXPIRES_IN
+        if options.get('window'):
+            # Same signature for the whole window, and still valid for at
+            # least expires_in seconds at its end.
+            timestamp = _window_start(timestamp, options['window'])
+            expires_in = int(expires_in) + int(options['window'])
+        return self._forge_signature(
+            method, canonical_uri, host,
+            timestamp=timestamp,
+            output=options.get('output'),
+            mime_type=options.get('mime_type'),
+            headers=options.get('headers'),
+            query=options.get('query'),
+            payload_hash=payload_hash,
+            expires_in=expires_in, credentials=credentials)
+
+    def _iter_signed_chunks(self, chunks, content_length, seed_signature,
+                            amz_date, scope, signing_key):
+        # Each chunk signature is chained off the previous one, starting
+        # from the signature of the request headers.
+        prefix = '\n'.join([CHUNK_ALGORITHM, amz_date, scope, '']).encode()
+        suffix = '\n{0}\n'.format(EMPTY_PAYLOAD_HASH).encode()
+        key_state = hmac.new(signing_key, digestmod=hashlib.sha256)
+        sha256 = hashlib.sha256
+        previous = seed_signature.encode()
+        total = 0
+        for chunk in chunks:
+            size = len(chunk)
+            total += size
+            if total > content_length:
+                raise Exception('The payload is longer than content_length.')
+            mac = key_state.copy()
+            mac.update(prefix + previous + suffix +
+                       sha256(chunk).hexdigest().encode())
+            previous = mac.hexdigest().encode()
+            yield b'%x;chunk-signature=%s\r\n' % (size, previous)
+            yield chunk
+            yield b'\r\n'
+        if total != content_length:
+            raise Exception('The payload is shorter than content_length.')
+        mac = key_state.copy()
+        mac.update(prefix + previous + suffix + EMPTY_PAYLOAD_HASH.encode())
+        yield b'0;chunk-signature=%s\r\n\r\n' % mac.hexdigest().encode()
+
+    def sign_chunked_upload(self, filename, payload, content_length,
+                            chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        if chunk_size < MIN_CHUNK_SIZE:
+            raise Exception('chunk_size must be at least %d bytes.'
+                            % MIN_CHUNK_SIZE)
+        timestamp = kwargs.get('timestamp') or _utcnow()
+        headers = {}
+        encoding = 'aws-chunked'
+        for name, value in (kwargs.get('headers') or {}).items():
+            if name.lower() == 'content-encoding':
+                encoding += ',' + value
+            else:
+                headers[name] = value
+        headers.update({
+            'content-encoding': encoding,
+            'content-length': str(_encoded_length(content_length,
+                                                  chunk_size)),
+            'x-amz-decoded-content-length': str(content_length)})
+        options = dict(kwargs, timestamp=timestamp, output='headers',
+                       headers=headers, payload_hash=STREAMING_PAYLOAD)
+        # The seed and the chunks must be signed with the same credentials.
+        credentials = self._credentials
+        request_headers = self._sign_operation('PUT', filename, options,
+                                               credentials)
+        seed_signature = request_headers['Authorization'].rsplit('=', 1)[1]
+        amz_date, datestamp = _format_amz_date(timestamp)
+        scope = '{0}/{1}/s3/aws4_request'.format(datestamp, self.REGION)
+        body = self._iter_signed_chunks(
+            _iter_chunks(payload, chunk_size), content_length,
+            seed_signature, amz_date, scope,
+            self._signing_key(datestamp, self.REGION,
+                              secret_key=credentials.AWS_SECRET_KEY))
+        return request_headers, body
@@ -0,0 +1,138 @@
+import hmac
+import time
+import calendar
+from urllib.parse import quote
+
+from .cache import ExpiringSet
+from .s3signedauth import (S3SignedURL, SignerRegistry, SUB_RESOURCES,
+                           _b64, _headers_template, _string_to_sign,
+                           _sub_resources)
+
+# Requests are accepted up to 15 minutes away from the server time, as S3
+# does.
+DEFAULT_MAX_SKEW = 900
+# Peak number of accepted requests per second the replay cache is sized
+# for, each remembered signature takes about 300 bytes.
+DEFAULT_REQUEST_RATE = 1000
+
+_MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+           'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+# Last parsed x-amz-date, as a (value, epoch) tuple. Clients signing in
+# bulk send the same date many times in a row.
+_last_date = (None, None)
+
+
+def _parse_date(value):
+    global _last_date
+    last = _last_date
+    if last[0] == value:
+        return last[1]
+    # e.g. "Wed, 01 Oct 2014 00:42:00 GMT"
+    try:
+        _, day, month, year, clock, _ = value.split()
+        hour, minute, second = clock.split(':')
+        epoch = calendar.timegm((int(year), _MONTHS[month], int(day),
+                                 int(hour), int(minute), int(second)))
+    except (ValueError, KeyError):
+        return None
+    _last_date = (value, epoch)
+    return epoch
+
+
+class RequestVerifier(object):
+
+    def __init__(self, signers, MAX_SKEW=DEFAULT_MAX_SKEW,
+                 REPLAY_CACHE_SIZE=None, REJECT_REPLAYS=True,
+                 REQUEST_RATE=DEFAULT_REQUEST_RATE):
+        if isinstance(signers, S3SignedURL):
+            registry = SignerRegistry()
+            registry.add(signers.AWS_KEY, signers.AWS_SECRET_KEY)
+            signers = registry
+        elif not isinstance(signers, SignerRegistry):
+            raise Exception('signers must be either a S3SignedURL or a '
+                            'SignerRegistry instance.')
+        self.signers = signers
+        self.MAX_SKEW = MAX_SKEW
+        self.REJECT_REPLAYS = REJECT_REPLAYS
+        if REPLAY_CACHE_SIZE is None:
+            # Signatures are remembered for about MAX_SKEW seconds.
+            REPLAY_CACHE_SIZE = MAX_SKEW * REQUEST_RATE
+        # Full of signatures which are still valid, it rejects requests
+        # rather than forgetting some, which would let them be replayed.
+        self._seen = ExpiringSet(REPLAY_CACHE_SIZE)
+        self.clock = time.time
+
+    def _check(self, aws_key, signature, s3_req_string, valid_until, now):
+        key = self.signers.find(aws_key)
+        if key is None:
+            return False
+        expected = _b64(key.digest(s3_req_string.encode('utf-8')))
+        # compare_digest only takes ASCII str, signatures come from clients.
+        if not hmac.compare_digest(expected.encode('ascii'),
+                                   signature.encode('utf-8')):
+            return False
+        if self.REJECT_REPLAYS:
+            # A signature only has to be remembered while it is valid.
+            return self._seen.add((aws_key, signature),
+                                  max(valid_until, now + 1), now)
+        return True
+
+    def verify(self, method, path, headers_or_query, mime_type=None,
+               now=None, sub_resources=None):
+        if now is None:
+            now = self.clock()
+        params = {}
+        for name, value in headers_or_query.items():
+            params[name.lower()] = value
+        authorization = params.get('authorization')
+        if authorization:
+            # Authorization: AWS <AWS_KEY>:<signature>
+            if not authorization.startswith('AWS '):
+                return False
+            aws_key, _, signature = authorization[4:].partition(':')
+            date_value = params.get('x-amz-date')
+            if not signature or not date_value:
+                return False
+            timestamp = _parse_date(date_value.strip())
+            if timestamp is None or abs(now - timestamp) > self.MAX_SKEW:
+                return False
+            # Only the Content-MD5, Content-Type and x-amz-* headers are
+            # signed, the date is added by _string_to_sign.
+            signed_headers = {}
+            for name, value in headers_or_query.items():
+                lower = name.lower()
+                if lower in ('content-md5', 'content-type') or (
+                        lower.startswith('x-amz-') and lower != 'x-amz-date'):
+                    signed_headers[name] = value
+            s3_req_string = _string_to_sign(
+                method, path, 'x-amz-date:' + date_value.strip(), mime_type,
+                signed_headers, sub_resources)
+            return self._check(aws_key, signature, s3_req_string,
+                               timestamp + self.MAX_SKEW, now)
+        aws_key = params.get('awsaccesskeyid')
+        signature = params.get('signature')
+        expires = params.get('expires')
+        if not aws_key or not signature or not expires:
+            return False
+        try:
+            expires_at = int(expires)
+        except ValueError:
+            return False
+        if now > expires_at:
+            return False
+        if sub_resources is None:
+            # Blank values are the ones of sub-resources given without one,
+            # e.g. "?uploads".
+            sub_resources = dict(
+                (name, value or None)
+                for name, value in headers_or_query.items()
+                if name in SUB_RESOURCES)
+        # Same string to sign as S3SignedURL.iter_presigned_urls, the
+        # session token of temporary credentials being signed as a header.
+        token = params.get('x-amz-security-token')
+        template, values = _headers_template(
+            {'x-amz-security-token': token} if token else None)
+        s3_req_string = template.format(
+            method, params.get('content-type', mime_type) or '', expires, '',
+            quote(path) + _sub_resources(sub_resources)[0], *values)
+        return self._check(aws_key, signature, s3_req_string, expires_at, now)
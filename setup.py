@@ -9,8 +9,11 @@ setuptools.setup(name='s3-signed-auth',
                  author='Julien Buty',
                  author_email='julien.buty@gmail.com',
                  url='http://github.com/nepsilon/s3-signed-auth',
-                 py_modules=['s3-signed-auth'],
+                 packages=['s3signedauth'],
                  install_requires=[],
+                 python_requires='>=3.7',
+                 entry_points={'console_scripts': [
+                     's3-signed-auth = s3signedauth.cli:main']},
                  license='MIT License',
                  zip_safe=False,
                  keywords='s3 aws http rest authenticate',
@@ -18,4 +21,5 @@ setuptools.setup(name='s3-signed-auth',
                               'License :: OSI Approved :: MIT License',
                               'Topic :: Internet :: WWW/HTTP',
                               'Programming Language :: Python',
+                              'Programming Language :: Python :: 3',
                               'Environment :: Web Environment'])